@@ -6,11 +6,12 @@ to demonstrate the impact of caching and predictive routing.
 
 import random
 import statistics
+import threading
 import time
-from unittest.mock import MagicMock, patch
+from unittest.mock import patch
 
 from src.agent_wrapper import BedrockAgentOptimizer
-from src.config import OptimizerConfig
+from src.config import get_config
 
 
 # Simulated agent latencies (seconds)
@@ -20,15 +21,22 @@ AGENT_LATENCY = {
     "summarizer": (0.5, 0.9),
 }
 
+# Portion of a cold call spent assembling session context; a pre-warmed
+# session skips it.
+COLD_START_S = 0.2
+# Cost of the connection warm-up a pre-load performs (DNS + TLS handshake).
+TLS_HANDSHAKE_S = 0.05
+
 AGENT_CHAIN = ["classifier", "retriever", "summarizer"]
 NUM_REQUESTS = 200
 REPEAT_QUERY_RATE = 0.4  # 40% of queries are repeats (cache-friendly)
 
 
-def simulate_agent_call(agent_id: str, *args, **kwargs):
+def simulate_agent_call(agent_id: str, warm: bool = False):
     """Simulate a Bedrock agent call with realistic latency."""
     lo, hi = AGENT_LATENCY.get(agent_id, (0.3, 0.8))
-    time.sleep(random.uniform(lo, hi))
+    latency = random.uniform(lo, hi)
+    time.sleep(latency - COLD_START_S if warm else latency)
     return {
         "completion": [
             {"chunk": {"bytes": f"Response from {agent_id}".encode()}}
@@ -36,6 +44,38 @@ def simulate_agent_call(agent_id: str, *args, **kwargs):
     }
 
 
+class SimulatedBedrock:
+    """Stands in for the Bedrock client so pre-loads have a measurable effect.
+
+    A pre-load's connection warm-up costs only the handshake, and its session
+    probe costs nothing but marks the session warm. The next real call on a
+    warm session skips the cold-start portion of its latency.
+
+    Warm starts therefore only come from session probes, which are off unless
+    PRELOAD_PROBE_THRESHOLD is set below the router's confidence (e.g. 0.9).
+    """
+
+    def __init__(self):
+        self._warm: set[tuple[str, str]] = set()
+        self._lock = threading.Lock()
+        self.warm_calls = 0
+
+    def send(self, request):
+        time.sleep(TLS_HANDSHAKE_S)
+
+    def invoke_agent(self, agentId: str, sessionId: str, inputText: str, **kwargs):
+        session = (agentId, sessionId)
+        if inputText.startswith("[PRELOAD]"):
+            with self._lock:
+                self._warm.add(session)
+            return {"completion": []}
+        with self._lock:
+            warm = session in self._warm
+            self._warm.discard(session)
+            self.warm_calls += warm
+        return simulate_agent_call(agentId, warm=warm)
+
+
 def generate_queries(n: int) -> list[str]:
     """Generate a mix of unique and repeated queries."""
     unique = [f"Query about topic {i}" for i in range(int(n * (1 - REPEAT_QUERY_RATE)))]
@@ -59,15 +99,18 @@ def run_baseline(queries: list[str]) -> list[float]:
 
 def run_optimized(queries: list[str]) -> list[float]:
     """Run agents through the optimizer with caching and prediction."""
-    config = OptimizerConfig()
+    config = get_config()
     optimizer = BedrockAgentOptimizer(config)
 
     # Seed the router with some historical traces
     for _ in range(50):
         optimizer.router.ingest_trace(AGENT_CHAIN)
 
+    bedrock = SimulatedBedrock()
+    http_session = optimizer._bedrock._endpoint.http_session
     latencies = []
-    with patch.object(optimizer._bedrock, "invoke_agent", side_effect=simulate_agent_call):
+    with patch.object(optimizer._bedrock, "invoke_agent", side_effect=bedrock.invoke_agent), \
+            patch.object(http_session, "send", side_effect=bedrock.send):
         for query in queries:
             start = time.monotonic()
             optimizer.run_chain(AGENT_CHAIN, query)
@@ -76,6 +119,8 @@ def run_optimized(queries: list[str]) -> list[float]:
 
     print(f"  Cache stats: {optimizer.cache.stats()}")
     print(f"  Router stats: {optimizer.router.stats()}")
+    # Only session probes warm a session; see PRELOAD_PROBE_THRESHOLD
+    print(f"  Warm starts (session probes only): {bedrock.warm_calls}")
     return latencies
 
 
@@ -1,38 +1,106 @@
 """Wrapper around Bedrock agent invocation with caching and predictive pre-loading."""
 
 import argparse
+import codecs
 import json
 import logging
+import threading
 import time
+from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor, Future
 
 import boto3
+from botocore.awsrequest import AWSRequest
+from botocore.config import Config
 
 from .cache import AgentResponseCache
-from .config import OptimizerConfig
+from .config import OptimizerConfig, get_config
 from .router import PredictiveRouter
 
 logger = logging.getLogger(__name__)
 
+# Executors and botocore clients are expensive to build and safe to share
+# across threads, so every optimizer in the process reuses the same ones.
+_shared_lock = threading.Lock()
+_session: boto3.session.Session | None = None
+_clients: dict[tuple[str, int], object] = {}
+_executors: dict[int, ThreadPoolExecutor] = {}
+
+
+def _get_bedrock_client(region: str, pool_size: int):
+    """Return the process-wide bedrock-agent-runtime client for a region."""
+    global _session
+    with _shared_lock:
+        client = _clients.get((region, pool_size))
+        if client is None:
+            if _session is None:
+                _session = boto3.session.Session()
+            client = _session.client(
+                "bedrock-agent-runtime",
+                region_name=region,
+                config=Config(
+                    max_pool_connections=pool_size,
+                    retries={"max_attempts": 2, "mode": "adaptive"},
+                    tcp_keepalive=True,
+                ),
+            )
+            _clients[(region, pool_size)] = client
+        return client
+
+
+def _get_executor(max_workers: int) -> ThreadPoolExecutor:
+    """Return the process-wide executor with the requested number of workers."""
+    with _shared_lock:
+        executor = _executors.get(max_workers)
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=max_workers, thread_name_prefix="bedrock-preload"
+            )
+            _executors[max_workers] = executor
+        return executor
+
 
 class BedrockAgentOptimizer:
     """Orchestrates multi-agent Bedrock calls with caching + predictive routing."""
 
     def __init__(self, config: OptimizerConfig | None = None):
-        self.config = config or OptimizerConfig()
+        self.config = config or get_config()
         self.cache = AgentResponseCache(self.config)
         self.router = PredictiveRouter(self.config)
-        self._bedrock = boto3.client(
-            "bedrock-agent-runtime", region_name=self.config.aws_region
+        self._bedrock = _get_bedrock_client(
+            self.config.aws_region,
+            max(self.config.bedrock_pool_size, self.config.max_parallel_requests),
         )
-        self._executor = ThreadPoolExecutor(max_workers=4)
-        self._preloaded: dict[str, Future] = {}
+        self._executor = _get_executor(self.config.max_parallel_requests)
+        # predicted agent_id -> (future, submitted_at, from_agent), oldest first
+        self._preloaded: OrderedDict[str, tuple[Future, float, str]] = OrderedDict()
+        self._preload_lock = threading.Lock()
+
+    def _invoke_agent(
+        self,
+        agent_id: str,
+        payload: dict,
+        context: dict | None = None,
+        check_cache: bool = True,
+        cache_payload: dict | None = None,
+    ) -> dict:
+        """Call a single Bedrock agent, using cache if available.
 
-    def _invoke_agent(self, agent_id: str, payload: dict, context: dict | None = None) -> dict:
-        """Call a single Bedrock agent, using cache if available."""
-        cached = self.cache.get(agent_id, payload, context)
-        if cached:
-            return cached
+        Pass ``check_cache=False`` when the caller has already looked this
+        payload up (e.g. in a batched ``mget``) and knows it missed. When
+        ``cache_payload`` is given (a chain step's projected payload), the
+        response is cached under it instead of ``payload``; such entries are
+        session-independent, so they are keyed without ``context``.
+        """
+        cache_context = context
+        if cache_payload is None:
+            cache_payload = payload
+        else:
+            cache_context = None
+        if check_cache:
+            cached = self.cache.get(agent_id, cache_payload, cache_context)
+            if cached:
+                return cached
 
         response = self._bedrock.invoke_agent(
             agentId=agent_id,
@@ -41,11 +109,15 @@ class BedrockAgentOptimizer:
             inputText=payload.get("input_text", ""),
         )
 
-        # Collect the streamed response
-        completion = ""
+        # Collect the streamed response. The incremental decoder holds back a
+        # multi-byte character split across chunks until it is complete.
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        parts = []
         for event in response.get("completion", []):
             chunk = event.get("chunk", {})
-            completion += chunk.get("bytes", b"").decode("utf-8")
+            parts.append(decoder.decode(chunk.get("bytes", b"")))
+        parts.append(decoder.decode(b"", final=True))
+        completion = "".join(parts)
 
         result = {
             "agent_id": agent_id,
@@ -53,26 +125,164 @@ class BedrockAgentOptimizer:
             "timestamp": time.time(),
         }
 
-        self.cache.put(agent_id, payload, result, context)
+        self.cache.put(agent_id, cache_payload, result, cache_context)
         return result
 
-    def _preload_context(self, agent_id: str, context: dict):
-        """Pre-warm the next agent's context in a background thread."""
+    def _warm_connection(self):
+        """Make sure a pooled HTTPS connection to the Bedrock endpoint is open.
+
+        The unsigned HEAD is rejected by the service, but it resolves DNS and
+        completes the TLS handshake, and botocore returns the connection to
+        its pool for the next real call to reuse. Nothing is billed.
+        """
+        endpoint = self._bedrock._endpoint
+        endpoint.http_session.send(AWSRequest(method="HEAD", url=endpoint.host).prepare())
+
+    def _preload_context(
+        self, agent_id: str, context: dict, confidence: float = 0.0
+    ) -> bool:
+        """Pre-warm the next agent's context in a background thread.
+
+        Returns:
+            True if the pre-load completed, False if it failed.
+        """
         logger.info("Pre-loading context for agent %s", agent_id)
-        # Pre-warming: send a lightweight probe to initialize the session
         try:
-            self._bedrock.invoke_agent(
-                agentId=agent_id,
-                agentAliasId="TSTALIASID",
-                sessionId=context.get("session_id", "preload"),
-                inputText="[PRELOAD] Initialize session context.",
-            )
+            self._warm_connection()
+            # A probe is a billed invocation and adds a turn to the chain's
+            # session before the real call, so it is opt-in via the threshold.
+            if confidence > self.config.preload_probe_threshold:
+                self._bedrock.invoke_agent(
+                    agentId=agent_id,
+                    agentAliasId="TSTALIASID",
+                    sessionId=context.get("session_id", "preload"),
+                    inputText="[PRELOAD] Initialize session context.",
+                )
         except Exception as e:
             logger.warning("Preload failed for %s: %s", agent_id, e)
+            return False
+        return True
+
+    def _preload_next(
+        self, agent_id: str, context: dict, history: list[str]
+    ) -> str | None:
+        """Submit a pre-load for the agent predicted to follow ``agent_id``.
+
+        ``history`` is the agents that ran before ``agent_id`` in this chain.
+
+        Returns:
+            The agent that is being pre-loaded, or None.
+        """
+        predicted, confidence = self.router.should_preload(agent_id, history)
+        if not predicted:
+            return None
+        with self._preload_lock:
+            if predicted in self._preloaded:
+                return None
+            future = self._executor.submit(
+                self._preload_context, predicted, context, confidence
+            )
+            self._preloaded[predicted] = (future, time.monotonic(), agent_id)
+            while len(self._preloaded) > self.config.preload_max_pending:
+                stale_agent, (stale, _, from_agent) = self._preloaded.popitem(last=False)
+                self._discard_preload(stale, from_agent, stale_agent)
+        return predicted
+
+    def _take_preload(self, agent_id: str) -> tuple[Future, str] | None:
+        """Claim the pending pre-load for ``agent_id``, if there is one.
+
+        Returns:
+            ``(future, from_agent)``; the caller reports the outcome once the
+            future has resolved.
+        """
+        with self._preload_lock:
+            entry = self._preloaded.pop(agent_id, None)
+        if entry is None:
+            return None
+        future, _, from_agent = entry
+        return future, from_agent
+
+    def _drop_preload(self, agent_id: str, from_agent: str):
+        """Discard the pre-load of ``agent_id`` made after ``from_agent``."""
+        with self._preload_lock:
+            entry = self._preloaded.get(agent_id)
+            if entry is None or entry[2] != from_agent:
+                return
+            del self._preloaded[agent_id]
+        self._discard_preload(entry[0], from_agent, agent_id)
+
+    def _expire_preloads(self):
+        """Drop pre-loads that have waited longer than ``preload_ttl_ms``."""
+        cutoff = time.monotonic() - self.config.preload_ttl_ms / 1000
+        with self._preload_lock:
+            while self._preloaded:
+                agent_id, (future, submitted_at, from_agent) = next(
+                    iter(self._preloaded.items())
+                )
+                if submitted_at >= cutoff:
+                    break
+                del self._preloaded[agent_id]
+                self._discard_preload(future, from_agent, agent_id)
+
+    def _discard_preload(self, future: Future, from_agent: str, agent_id: str):
+        future.cancel()
+        self.router.record_preload(False, from_agent, agent_id)
+
+    @staticmethod
+    def _projected_payloads(agent_ids: list[str], input_text: str) -> list[dict]:
+        """Build a cache payload for every chain step that is known up front.
+
+        A step's real input is the previous step's output, which is unknown
+        until that step runs. Keying downstream steps on the chain input plus
+        the agents upstream of them gives each step a stable identity, so the
+        whole chain can be looked up in a single ``mget``.
+
+        Every chain runs in a fresh Bedrock session, so the session id does
+        not affect any step's output and is left out; a repeated query hits
+        no matter when it is repeated.
+        """
+        return [
+            {"input_text": input_text, "upstream": agent_ids[:i]}
+            for i in range(len(agent_ids))
+        ]
+
+    def _lookup_cached_prefix(
+        self, agent_ids: list[str], input_text: str
+    ) -> tuple[list[dict], list[dict]]:
+        """Resolve the leading run of chain steps that are already cached.
+
+        Returns:
+            ``(prefix, projected)``: cached results for the leading steps that
+            hit, in chain order, and the projected payload of every step.
+        """
+        start = time.monotonic()
+        projected = self._projected_payloads(agent_ids, input_text)
+        # Counted below, once per step: a step after the first miss cannot use
+        # its prefetched result even when it hit, so it counts as a miss.
+        prefetched = self.cache.mget(
+            [(agent_id, p, None) for agent_id, p in zip(agent_ids, projected)],
+            count=False,
+        )
+        lookup_ms = round((time.monotonic() - start) * 1000, 1)
+
+        # A prefetched step is only usable while every step before it was also
+        # a hit, since its real input is their output.
+        prefix = []
+        for cached in prefetched:
+            if not cached:
+                break
+            cached["latency_ms"] = 0.0 if prefix else lookup_ms
+            prefix.append(cached)
+        self.cache.record_lookups(hits=len(prefix), misses=len(agent_ids) - len(prefix))
+        return prefix, projected
 
     def run_chain(self, agent_ids: list[str], input_text: str) -> list[dict]:
         """Execute a chain of agents with optimization.
 
+        The whole chain is first looked up in one batched cache read. A fully
+        cached chain returns without invoking any agent; otherwise the chain
+        is split at the first miss and only the tail is run, in order.
+
         Args:
             agent_ids: Ordered list of Bedrock agent IDs to invoke.
             input_text: Initial user input.
@@ -80,41 +290,65 @@ class BedrockAgentOptimizer:
         Returns:
             List of agent responses in chain order.
         """
-        results = []
-        current_input = input_text
+        self._expire_preloads()
         context = {"session_id": f"chain-{int(time.time())}"}
+        results, projected = self._lookup_cached_prefix(agent_ids, input_text)
+        for i in range(min(len(results), len(agent_ids) - 1)):
+            self.router.record_transition(agent_ids[i], agent_ids[i + 1], agent_ids[:i])
+        if len(results) == len(agent_ids):
+            return results
 
-        for i, agent_id in enumerate(agent_ids):
+        current_input = results[-1].get("output", "") if results else input_text
+        predicted = None
+        for i in range(len(results), len(agent_ids)):
+            agent_id = agent_ids[i]
             payload = {"input_text": current_input, "session_id": context["session_id"]}
 
+            # A pre-load for a different agent was a misprediction; report it
+            # now rather than letting it sit until it expires
+            if predicted is not None and predicted != agent_id:
+                self._drop_preload(predicted, agent_ids[i - 1])
+
             # Check if we already pre-loaded this agent
-            if agent_id in self._preloaded:
+            claimed = self._take_preload(agent_id)
+            warm = False
+            if claimed is not None:
+                preload, from_agent = claimed
                 logger.info("Agent %s was pre-loaded, expecting warm start", agent_id)
                 try:
-                    self._preloaded[agent_id].result(timeout=1)
+                    warm = bool(preload.result(timeout=1))
                 except Exception:
                     pass  # Pre-load is best-effort
-                del self._preloaded[agent_id]
+                # Only a pre-load that finished in time counts as a success
+                self.router.record_preload(warm, from_agent, agent_id)
 
-            # Execute current agent
+            # Start warming the likely next agent before running this one, so the
+            # pre-load overlaps with this agent's latency instead of following it
+            predicted = None
+            if i < len(agent_ids) - 1:
+                predicted = self._preload_next(agent_id, context, agent_ids[:i])
+
+            # Execute current agent. A step's real key is scoped to this chain's
+            # fresh session, so nothing else could have cached it; the step is
+            # cached only under its projected key, which was already checked.
             start = time.monotonic()
-            result = self._invoke_agent(agent_id, payload, context)
+            result = self._invoke_agent(
+                agent_id,
+                payload,
+                context,
+                check_cache=False,
+                cache_payload=projected[i],
+            )
             elapsed = time.monotonic() - start
             result["latency_ms"] = round(elapsed * 1000, 1)
+            result["warm"] = warm
             results.append(result)
 
             # Feed output as input to next agent
             current_input = result.get("output", "")
 
-            # Predictive pre-loading for the next agent
             if i < len(agent_ids) - 1:
-                self.router.record_transition(agent_id, agent_ids[i + 1])
-                predicted = self.router.should_preload(agent_id)
-                if predicted:
-                    future = self._executor.submit(
-                        self._preload_context, predicted, context
-                    )
-                    self._preloaded[predicted] = future
+                self.router.record_transition(agent_id, agent_ids[i + 1], agent_ids[:i])
 
         return results
 
@@ -124,7 +358,11 @@ class BedrockAgentOptimizer:
         return {
             "total_latency_ms": round(sum(latencies), 1),
             "per_agent": [
-                {"agent": r["agent_id"], "latency_ms": r["latency_ms"]}
+                {
+                    "agent": r["agent_id"],
+                    "latency_ms": r["latency_ms"],
+                    "warm": r.get("warm", False),
+                }
                 for r in results
             ],
             "cache": self.cache.stats(),
@@ -1,52 +1,328 @@
 """Redis caching layer for Bedrock agent responses."""
 
-import hashlib
-import json
 import logging
+import threading
 
+import msgpack
 import redis
+from cachetools import TTLCache
+from redis.cluster import RedisCluster
+import xxhash
+import zstandard
 
 from .config import OptimizerConfig
+from .semantic import SemanticIndex
 
 logger = logging.getLogger(__name__)
 
+# One-byte tags prefixed to every stored value so reads know how to decode it
+_TAG_MSGPACK = b"m"
+_TAG_ZSTD = b"z"
+
+
+def _canonical(value):
+    """Rebuild ``value`` with every mapping's keys in sorted order, at any depth."""
+    if isinstance(value, dict):
+        return {k: _canonical(v) for k, v in sorted(value.items())}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    return value
+
 
 class AgentResponseCache:
     """Caches agent responses keyed on (agent_id, input, context) hash."""
 
     def __init__(self, config: OptimizerConfig):
         self.config = config
-        self.client = redis.Redis(
-            host=config.redis_host,
-            port=config.redis_port,
-            decode_responses=True,
-        )
+        # Created on first use, so building the cache never touches the network
+        self._client = None
+        self._client_lock = threading.Lock()
         self._hits = 0
         self._misses = 0
+        # zstd contexts are not safe to share between threads
+        self._zstd = threading.local()
+        # In-process L1 in front of Redis for responses this process just saw.
+        # Entries expire after cache_ttl like their Redis copies, so L1 never
+        # keeps serving a response that Redis has already dropped.
+        self._l1 = TTLCache(maxsize=config.l1_size, ttl=config.cache_ttl)
+        # Keys that recently missed in Redis; re-checking them within the TTL
+        # would almost always miss again, so skip the round trip.
+        self._negative = TTLCache(
+            maxsize=config.negative_cache_size, ttl=config.negative_cache_ttl
+        )
+        # Guards both in-process caches (cachetools containers are not
+        # thread-safe) and the hit/miss counters
+        self._local_lock = threading.Lock()
+        self.semantic = SemanticIndex(config) if config.semantic_cache else None
+        self._semantic_hits = 0
+
+    @property
+    def client(self) -> redis.Redis | RedisCluster:
+        """Redis handle backed by a pool shared by every thread using this cache."""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self._connect()
+        return self._client
+
+    @client.setter
+    def client(self, client: redis.Redis | RedisCluster):
+        self._client = client
+
+    def _connect(self) -> redis.Redis | RedisCluster:
+        config = self.config
+        pool_size = max(config.redis_pool_size, config.max_parallel_requests * 2)
+        if config.redis_cluster:
+            return RedisCluster(
+                host=config.redis_host,
+                port=config.redis_port,
+                max_connections=pool_size,
+                decode_responses=False,
+            )
+        # A blocking pool makes callers wait for a free connection under
+        # load instead of failing once every connection is checked out.
+        return redis.Redis(
+            connection_pool=redis.BlockingConnectionPool(
+                host=config.redis_host,
+                port=config.redis_port,
+                max_connections=pool_size,
+                decode_responses=False,
+            )
+        )
 
     @staticmethod
     def _build_key(agent_id: str, payload: dict, context: dict | None = None) -> str:
-        raw = json.dumps(
-            {"agent_id": agent_id, "payload": payload, "context": context or {}},
-            sort_keys=True,
+        # Fast path for the shape run_chain sends on every step: just the text
+        # and session, with the session repeated as the only context entry.
+        # Those three strings identify the request, so skip the packing. Each
+        # is length-prefixed so no two triples produce the same bytes, and the
+        # leading digit keeps them apart from packed keys (a msgpack array).
+        if len(payload) == 2 and context is not None and len(context) == 1:
+            input_text = payload.get("input_text")
+            session_id = payload.get("session_id")
+            if (
+                type(input_text) is str
+                and type(session_id) is str
+                and context.get("session_id") == session_id
+            ):
+                raw = (
+                    f"{len(agent_id)}:{agent_id}{len(input_text)}:{input_text}"
+                    f"{len(session_id)}:{session_id}"
+                ).encode()
+                return f"bedrock_cache:{{{agent_id}}}:{xxhash.xxh3_128_hexdigest(raw)}"
+
+        # Payload and context are packed with keys sorted at every level, so
+        # equal dicts always hash the same regardless of insertion order. Values
+        # keep their types, so e.g. None and "None" (or a missing and an empty
+        # field) differ.
+        raw = msgpack.packb(
+            [agent_id, _canonical(payload), _canonical(context or {})],
+            use_bin_type=True,
+        )
+        # The {agent_id} hash tag pins all of an agent's entries to one
+        # Redis Cluster slot, so batches for that agent stay on one node.
+        return f"bedrock_cache:{{{agent_id}}}:{xxhash.xxh3_128_hexdigest(raw)}"
+
+    def _encode(self, response: dict) -> bytes:
+        packed = msgpack.packb(response, use_bin_type=True)
+        if len(packed) < self.config.compression_threshold:
+            return _TAG_MSGPACK + packed
+        compressor = getattr(self._zstd, "compressor", None)
+        if compressor is None:
+            compressor = self._zstd.compressor = zstandard.ZstdCompressor(level=1)
+        return _TAG_ZSTD + compressor.compress(packed)
+
+    def _decode(self, raw: bytes) -> dict | None:
+        tag, body = raw[:1], raw[1:]
+        if tag == _TAG_ZSTD:
+            decompressor = getattr(self._zstd, "decompressor", None)
+            if decompressor is None:
+                decompressor = self._zstd.decompressor = zstandard.ZstdDecompressor()
+            body = decompressor.decompress(body)
+        elif tag != _TAG_MSGPACK:
+            # e.g. a JSON entry written by an older release; treat as a miss
+            logger.warning("Ignoring cache value with unknown encoding %r", tag)
+            return None
+        return msgpack.unpackb(body, raw=False)
+
+    @classmethod
+    def _semantic_scope(cls, agent_id: str, payload: dict, context: dict | None) -> str:
+        # Everything that identifies the request except its text and session,
+        # so near-duplicates are shared across conversations but never across
+        # agents or request shapes.
+        return cls._build_key(
+            agent_id,
+            {**payload, "input_text": "", "session_id": ""},
+            {k: v for k, v in (context or {}).items() if k != "session_id"},
         )
-        return f"bedrock_cache:{hashlib.sha256(raw.encode()).hexdigest()}"
+
+    def _fetch(self, keys: list[str]) -> list[bytes | None]:
+        """Read ``keys`` from Redis in one round trip."""
+        if self.config.redis_cluster:
+            # Keys for different agents live in different slots
+            return self.client.mget_nonatomic(keys)
+        return self.client.mget(keys)
+
+    def _semantic_matches(
+        self, lookups: list[tuple[str, str, dict, dict | None]]
+    ) -> list[dict | None]:
+        """Fetch responses of indexed near-duplicates of missed lookups.
+
+        ``lookups`` are ``(agent_id, key, payload, context)``. Matches still in
+        L1 are served from it; the rest are fetched in a single round trip.
+        """
+        found = self.semantic.lookup_many([
+            (
+                self._semantic_scope(agent_id, payload, context),
+                str(payload.get("input_text", "")),
+            )
+            for agent_id, _, payload, context in lookups
+        ])
+        matches = [
+            None if match == key else match
+            for (_, key, _, _), match in zip(lookups, found)
+        ]
+        responses: list[dict | None] = [None] * len(matches)
+        remote = []
+        with self._local_lock:
+            for i, match in enumerate(matches):
+                if match is not None:
+                    responses[i] = self._l1.get(match)
+                    if responses[i] is None:
+                        remote.append(i)
+        if remote:
+            for i, cached in zip(remote, self._fetch([matches[i] for i in remote])):
+                responses[i] = self._decode(cached) if cached else None
+        for (agent_id, _, _, _), match, response in zip(lookups, matches, responses):
+            if response is not None:
+                logger.debug("Semantic HIT for agent %s (key=%s)", agent_id, match[:16])
+        return responses
+
+    def _load(
+        self,
+        lookups: list[tuple[str, str, dict, dict | None]],
+        fetched: list[bytes | None],
+        count: bool = True,
+    ) -> list[dict | None]:
+        """Resolve ``(agent_id, key, payload, context)`` lookups from Redis values."""
+        responses = [self._decode(cached) if cached else None for cached in fetched]
+        if self.semantic is not None:
+            missed = [i for i, response in enumerate(responses) if response is None]
+            if missed:
+                matched = self._semantic_matches([lookups[i] for i in missed])
+                for i, response in zip(missed, matched):
+                    if response is not None:
+                        responses[i] = response
+                        # Counted even with count=False: a caller tallying hits
+                        # itself cannot see which came from a near-duplicate
+                        with self._local_lock:
+                            self._semantic_hits += 1
+
+        results = []
+        for (agent_id, key, _, _), response in zip(lookups, responses):
+            if response is not None:
+                logger.debug("Cache HIT for agent %s (key=%s)", agent_id, key[:16])
+                with self._local_lock:
+                    if count:
+                        self._hits += 1
+                    self._l1[key] = response
+                results.append(dict(response))
+                continue
+            logger.debug("Cache MISS for agent %s (key=%s)", agent_id, key[:16])
+            with self._local_lock:
+                if count:
+                    self._misses += 1
+                self._negative[key] = True
+            results.append(None)
+        return results
+
+    def _lookup_local(self, key: str, count: bool = True) -> tuple[bool, dict | None]:
+        """Check the in-process caches.
+
+        Returns:
+            ``(resolved, response)``: ``resolved`` is False when Redis must be asked.
+        """
+        with self._local_lock:
+            response = self._l1.get(key)
+            if response is not None:
+                if count:
+                    self._hits += 1
+                return True, dict(response)
+            if key in self._negative:
+                if count:
+                    self._misses += 1
+                return True, None
+        return False, None
 
     def get(self, agent_id: str, payload: dict, context: dict | None = None) -> dict | None:
         key = self._build_key(agent_id, payload, context)
-        cached = self.client.get(key)
-        if cached:
-            self._hits += 1
-            logger.debug("Cache HIT for agent %s (key=%s)", agent_id, key[:16])
-            return json.loads(cached)
-        self._misses += 1
-        logger.debug("Cache MISS for agent %s (key=%s)", agent_id, key[:16])
-        return None
+        resolved, response = self._lookup_local(key)
+        if resolved:
+            return response
+        return self._load([(agent_id, key, payload, context)], [self.client.get(key)])[0]
+
+    def mget(
+        self, items: list[tuple[str, dict, dict | None]], count: bool = True
+    ) -> list[dict | None]:
+        """Look up several ``(agent_id, payload, context)`` entries in one round trip.
+
+        With the semantic cache on, near-duplicate matches for the misses take
+        one more round trip between them.
+
+        Pass ``count=False`` when the caller decides which of the lookups are
+        real hits and misses, and reports them with ``record_lookups``.
+
+        Returns:
+            Cached responses in the same order as ``items``; ``None`` for misses.
+        """
+        if not items:
+            return []
+        keys = [self._build_key(*item) for item in items]
+        results: list[dict | None] = [None] * len(keys)
+        pending = []
+        for i, key in enumerate(keys):
+            resolved, results[i] = self._lookup_local(key, count)
+            if not resolved:
+                pending.append(i)
+        if pending:
+            lookups = [(items[i][0], keys[i], items[i][1], items[i][2]) for i in pending]
+            fetched = self._fetch([keys[i] for i in pending])
+            for i, response in zip(pending, self._load(lookups, fetched, count)):
+                results[i] = response
+        return results
 
     def put(self, agent_id: str, payload: dict, response: dict, context: dict | None = None):
-        key = self._build_key(agent_id, payload, context)
-        self.client.setex(key, self.config.cache_ttl, json.dumps(response))
-        logger.debug("Cached response for agent %s (ttl=%ds)", agent_id, self.config.cache_ttl)
+        self.put_many([(agent_id, payload, response, context)])
+
+    def put_many(self, entries: list[tuple[str, dict, dict, dict | None]]):
+        """Store several ``(agent_id, payload, response, context)`` entries.
+
+        All writes are sent in one non-transactional pipeline, i.e. one round
+        trip per flush.
+        """
+        pipe = self.client.pipeline(transaction=False)
+        for agent_id, payload, response, context in entries:
+            key = self._build_key(agent_id, payload, context)
+            pipe.setex(key, self.config.cache_ttl, self._encode(response))
+            with self._local_lock:
+                self._l1[key] = dict(response)
+                self._negative.pop(key, None)
+            if self.semantic is not None:
+                self.semantic.add(
+                    self._semantic_scope(agent_id, payload, context),
+                    str(payload.get("input_text", "")),
+                    key,
+                )
+            logger.debug(
+                "Cached response for agent %s (ttl=%ds)", agent_id, self.config.cache_ttl
+            )
+        pipe.execute()
+
+    def record_lookups(self, hits: int = 0, misses: int = 0):
+        """Count lookups that were made with ``count=False``."""
+        with self._local_lock:
+            self._hits += hits
+            self._misses += misses
 
     @property
     def hit_rate(self) -> float:
@@ -58,4 +334,5 @@ class AgentResponseCache:
             "hits": self._hits,
             "misses": self._misses,
             "hit_rate": round(self.hit_rate, 3),
+            "semantic_hits": self._semantic_hits,
         }
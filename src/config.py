@@ -1,16 +1,84 @@
+import functools
 import os
 from dataclasses import dataclass, field
 
 
-@dataclass
+# Bedrock calls are I/O-bound, so size the worker pool well past the core count.
+DEFAULT_MAX_PARALLEL_REQUESTS = min(32, (os.cpu_count() or 4) * 5)
+
+
+def _env_flag(name: str, default: str = "false") -> bool:
+    return os.getenv(name, default).strip().lower() in ("1", "true", "yes", "on")
+
+
+@functools.lru_cache(maxsize=1)
+def _parse_agent_ids() -> tuple[str, ...]:
+    raw = os.getenv("BEDROCK_AGENT_IDS", "")
+    return tuple(a.strip() for a in raw.split(",") if a.strip())
+
+
+# Defaults are read from the environment once, at import time. Instances are
+# immutable (and hashable) so a single one can be shared via get_config().
+@dataclass(frozen=True, slots=True)
 class OptimizerConfig:
     redis_host: str = os.getenv("REDIS_HOST", "localhost")
     redis_port: int = int(os.getenv("REDIS_PORT", "6379"))
+    redis_cluster: bool = _env_flag("REDIS_CLUSTER")
+    # Redis connections shared by all threads; each command checks one out.
+    # Never smaller than two per worker, so cache reads and writes rarely wait.
+    redis_pool_size: int = int(
+        os.getenv("REDIS_POOL_SIZE", str(max(64, DEFAULT_MAX_PARALLEL_REQUESTS * 2)))
+    )
     cache_ttl: int = int(os.getenv("CACHE_TTL_SECONDS", "300"))
+    # Cached responses at least this large (packed bytes) are zstd-compressed
+    compression_threshold: int = int(os.getenv("CACHE_COMPRESSION_THRESHOLD", "4096"))
+    l1_size: int = int(os.getenv("L1_CACHE_SIZE", "1024"))
+    # In-process memory of recent Redis misses, so repeats skip the round trip
+    negative_cache_size: int = int(os.getenv("NEGATIVE_CACHE_SIZE", "10000"))
+    negative_cache_ttl: float = float(os.getenv("NEGATIVE_CACHE_TTL_SECONDS", "5"))
+    # Also serve near-duplicate inputs via embedding similarity (needs
+    # sentence-transformers). Matches are scoped by agent and request shape, not
+    # by session; chain entries are shared across sessions either way.
+    semantic_cache: bool = _env_flag("SEMANTIC_CACHE")
+    semantic_model: str = os.getenv(
+        "SEMANTIC_MODEL", "sentence-transformers/all-MiniLM-L6-v2"
+    )
+    semantic_threshold: float = float(os.getenv("SEMANTIC_THRESHOLD", "0.92"))
+    # Minimum word-set overlap (Jaccard) a semantic match must also have
+    semantic_min_overlap: float = float(os.getenv("SEMANTIC_MIN_OVERLAP", "0.8"))
+    semantic_max_entries: int = int(os.getenv("SEMANTIC_MAX_ENTRIES", "10000"))
     prediction_threshold: float = float(
         os.getenv("PREDICTION_CONFIDENCE_THRESHOLD", "0.7")
     )
+    # Longest agent history the router conditions on (1 = bigram model)
+    router_max_order: int = int(os.getenv("ROUTER_MAX_ORDER", "3"))
+    # Contexts kept by the router before least recently used ones are evicted
+    router_ngram_cap: int = int(os.getenv("ROUTER_NGRAM_CAP", "4096"))
+    # Pending pre-loads are capped and expire, so mispredictions cannot pile up
+    preload_max_pending: int = int(os.getenv("PRELOAD_MAX_PENDING", "64"))
+    preload_ttl_ms: int = int(os.getenv("PRELOAD_TTL_MS", "30000"))
+    # Pre-loads only warm the connection; a real (billed) session probe is sent
+    # when the prediction is more confident than this. A probe adds a turn to
+    # the chain's session ahead of the real call, so the (cached) output can
+    # depend on it. Off by default: confidence never exceeds 1.0.
+    preload_probe_threshold: float = float(os.getenv("PRELOAD_PROBE_THRESHOLD", "1.0"))
+    # A pre-load fires when (sampled pair success rate) x confidence reaches this
+    preload_expected_value_threshold: float = float(
+        os.getenv("PRELOAD_EV_THRESHOLD", "0.3")
+    )
     aws_region: str = os.getenv("AWS_REGION", "us-east-1")
-    agent_ids: list[str] = field(default_factory=lambda: os.getenv(
-        "BEDROCK_AGENT_IDS", ""
-    ).split(","))
+    max_parallel_requests: int = int(
+        os.getenv("MAX_PARALLEL_REQUESTS", str(DEFAULT_MAX_PARALLEL_REQUESTS))
+    )
+    # botocore HTTPS pool for bedrock-agent-runtime; never smaller than the
+    # executor, otherwise overflow connections are discarded and re-handshaked.
+    bedrock_pool_size: int = int(
+        os.getenv("BEDROCK_POOL_SIZE", str(max(50, DEFAULT_MAX_PARALLEL_REQUESTS)))
+    )
+    agent_ids: tuple[str, ...] = field(default_factory=_parse_agent_ids)
+
+
+@functools.lru_cache(maxsize=1)
+def get_config() -> OptimizerConfig:
+    """Return the process-wide configuration built from the environment."""
+    return OptimizerConfig()
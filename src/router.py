@@ -1,50 +1,223 @@
 """Predictive router that anticipates the next agent in a chain."""
 
 import logging
-from collections import Counter, defaultdict
+import random
+import threading
+from collections.abc import Callable, Sequence
+
+import numpy as np
+from cachetools import LRUCache
 
 from .config import OptimizerConfig
 
 logger = logging.getLogger(__name__)
 
 
+class _ContextRows(LRUCache):
+    """LRU map of context -> matrix row that hands evicted rows back for reuse."""
+
+    def __init__(self, maxsize: int, on_evict: Callable[[int], None]):
+        super().__init__(maxsize=maxsize)
+        self._on_evict = on_evict
+
+    def popitem(self):
+        context, row = super().popitem()
+        self._on_evict(row)
+        return context, row
+
+
 class PredictiveRouter:
     """Learns agent transition patterns and predicts the next agent to pre-warm.
 
-    Uses a simple bigram frequency model: given the current agent, predict
-    which agent is most likely to be invoked next based on historical traces.
+    Uses a variable-order Markov model: counts are kept for every context of
+    the last 1..``router_max_order`` agents, and a prediction backs off from
+    the longest context that has been observed to shorter ones. With order 1
+    this is the plain bigram model. Counts live in a dense matrix with one row
+    per context and one column per interned agent; the least recently used
+    contexts are evicted once ``router_ngram_cap`` is reached.
+
+    Whether a prediction is worth pre-loading is decided by Thompson sampling
+    over the measured pre-load outcomes of each agent pair, so pairs whose
+    pre-loads keep paying off are warmed even below ``prediction_threshold``.
     """
 
     def __init__(self, config: OptimizerConfig):
         self.config = config
-        # transition_counts[current_agent][next_agent] = count
-        self._transitions: dict[str, Counter] = defaultdict(Counter)
+        self._lock = threading.Lock()
+        # Agents are interned to small ints so contexts hash as int tuples
+        self._agent_to_id: dict[str, int] = {}
+        self._id_to_agent: list[str] = []
+        # Context (last agent ids, oldest first) -> row of _mat
+        self._ctx_row = _ContextRows(config.router_ngram_cap, self._release_row)
+        self._row_ctx: list[tuple[int, ...] | None] = []
+        self._free_rows: list[int] = []
+        # _mat[context, next_agent] = count; rows/cols are over-allocated and
+        # grown geometrically so new contexts and agents rarely trigger a copy.
+        self._mat = np.zeros((0, 0), dtype=np.int32)
+        self._row_sum = np.zeros(0, dtype=np.int64)
+        # _best[i] = column of the current most frequent successor of row i,
+        # kept up to date on every write so predictions never scan a row.
+        # Ties go to the lowest column, i.e. the agent seen first, as argmax.
+        self._best = np.zeros(0, dtype=np.intp)
         self._total_traces = 0
+        self._preload_hits = 0
+        self._preload_wasted = 0
+        # (from_agent, to_agent) -> [pre-loads used, pre-loads wasted]
+        self._preload_outcomes: dict[tuple[str, str], list[int]] = {}
+        self._rng = random.Random()
+
+    def _intern(self, agent_id: str) -> int:
+        idx = self._agent_to_id.get(agent_id)
+        if idx is None:
+            idx = len(self._id_to_agent)
+            self._agent_to_id[agent_id] = idx
+            self._id_to_agent.append(agent_id)
+            if idx >= self._mat.shape[1]:
+                grow = max(8, self._mat.shape[1])
+                self._mat = np.pad(self._mat, ((0, 0), (0, grow)))
+        return idx
+
+    def _row_for(self, context: tuple[int, ...]) -> int:
+        row = self._ctx_row.get(context)
+        if row is None:
+            if self._free_rows:
+                row = self._free_rows.pop()
+                self._row_ctx[row] = context
+            else:
+                row = len(self._row_ctx)
+                self._row_ctx.append(context)
+                if row >= self._mat.shape[0]:
+                    grow = max(8, self._mat.shape[0])
+                    self._mat = np.pad(self._mat, ((0, grow), (0, 0)))
+                    self._row_sum = np.pad(self._row_sum, (0, grow))
+                    self._best = np.pad(self._best, (0, grow))
+            # May evict the least recently used context, freeing its row
+            self._ctx_row[context] = row
+        return row
 
-    def record_transition(self, from_agent: str, to_agent: str):
-        """Record an observed agent-to-agent transition."""
-        self._transitions[from_agent][to_agent] += 1
-        self._total_traces += 1
+    def _release_row(self, row: int):
+        self._mat[row] = 0
+        self._row_sum[row] = 0
+        self._best[row] = 0
+        self._row_ctx[row] = None
+        self._free_rows.append(row)
+
+    def _recent(self, history: Sequence[str]) -> Sequence[str]:
+        """The part of ``history`` that the longest context can use."""
+        keep = self.config.router_max_order - 1
+        return history[-keep:] if keep else ()
+
+    def _contexts(self, current: int, history: Sequence[int]) -> list[tuple[int, ...]]:
+        """Every context ending at agent id ``current``, shortest first."""
+        keep = self.config.router_max_order - 1
+        recent = (current,)
+        if keep:
+            recent = (*history[-keep:], *recent)
+        return [recent[-k:] for k in range(1, len(recent) + 1)]
+
+    def _bump(self, i: int, j: int):
+        self._mat[i, j] += 1
+        self._row_sum[i] += 1
+        # Counts only ever grow by one, so only the updated cell can overtake
+        best = self._best[i]
+        if self._mat[i, j] > self._mat[i, best] or (
+            self._mat[i, j] == self._mat[i, best] and j < best
+        ):
+            self._best[i] = j
+
+    def _observed_row(self, current_agent: str, history: Sequence[str]) -> int | None:
+        """Row of the longest observed context ending at ``current_agent``."""
+        current = self._agent_to_id.get(current_agent)
+        if current is None:
+            return None
+        # Contexts never contain an unknown agent, so history stops at the last one
+        ids = []
+        for agent in reversed(self._recent(history)):
+            idx = self._agent_to_id.get(agent)
+            if idx is None:
+                break
+            ids.append(idx)
+        for context in reversed(self._contexts(current, ids[::-1])):
+            row = self._ctx_row.get(context)
+            if row is not None and self._row_sum[row]:
+                return row
+        return None
+
+    def record_transition(
+        self, from_agent: str, to_agent: str, history: Sequence[str] = ()
+    ):
+        """Record an observed agent-to-agent transition.
+
+        Args:
+            from_agent: Agent that just ran.
+            to_agent: Agent that ran next.
+            history: Agents that ran before ``from_agent``, oldest first.
+        """
+        with self._lock:
+            # Intern in chain order so ids match what ingest_trace would assign
+            ids = [self._intern(agent) for agent in self._recent(history)]
+            current = self._intern(from_agent)
+            j = self._intern(to_agent)
+            for context in self._contexts(current, ids):
+                self._bump(self._row_for(context), j)
+            self._total_traces += 1
 
     def ingest_trace(self, agent_sequence: list[str]):
         """Ingest a full agent chain trace (ordered list of agent IDs)."""
-        for i in range(len(agent_sequence) - 1):
-            self.record_transition(agent_sequence[i], agent_sequence[i + 1])
+        if len(agent_sequence) < 2:
+            return
+        order = self.config.router_max_order
+        with self._lock:
+            ids = [self._intern(agent) for agent in agent_sequence]
+            steps = [
+                (self._contexts(ids[i - 1], ids[max(0, i - order):i - 1]), ids[i])
+                for i in range(1, len(ids))
+            ]
+            unique_contexts = {c for contexts, _ in steps for c in contexts}
+            if len(unique_contexts) > self.config.router_ngram_cap:
+                # Rows could be evicted and reused mid-batch; apply one at a time
+                for contexts, j in steps:
+                    for context in contexts:
+                        self._bump(self._row_for(context), j)
+            else:
+                rows, cols = [], []
+                for contexts, j in steps:
+                    for context in contexts:
+                        rows.append(self._row_for(context))
+                        cols.append(j)
+                rows, cols = np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp)
+                np.add.at(self._mat, (rows, cols), 1)
+                np.add.at(self._row_sum, rows, 1)
+                touched = np.unique(rows)
+                self._best[touched] = self._mat[touched].argmax(axis=1)
+            self._total_traces += len(steps)
+
+    def _best_next(
+        self, current_agent: str, history: Sequence[str]
+    ) -> tuple[str | None, float]:
+        """Most frequent successor and its share, without any threshold."""
+        with self._lock:
+            i = self._observed_row(current_agent, history)
+            if i is None:
+                return None, 0.0
+            j = int(self._best[i])
+            return self._id_to_agent[j], float(self._mat[i, j] / self._row_sum[i])
 
-    def predict_next(self, current_agent: str) -> tuple[str | None, float]:
+    def predict_next(
+        self, current_agent: str, history: Sequence[str] = ()
+    ) -> tuple[str | None, float]:
         """Predict the most likely next agent given the current one.
 
+        Args:
+            current_agent: Agent that is running now.
+            history: Agents that ran before it, oldest first.
+
         Returns:
             (predicted_agent_id, confidence) or (None, 0.0) if unknown.
         """
-        counts = self._transitions.get(current_agent)
-        if not counts:
+        best_agent, confidence = self._best_next(current_agent, history)
+        if best_agent is None:
             return None, 0.0
-
-        total = sum(counts.values())
-        best_agent, best_count = counts.most_common(1)[0]
-        confidence = best_count / total
-
         if confidence >= self.config.prediction_threshold:
             logger.info(
                 "Predicting next agent: %s (confidence=%.2f)", best_agent, confidence
@@ -60,16 +233,69 @@ class PredictiveRouter:
         )
         return None, confidence
 
-    def should_preload(self, current_agent: str) -> str | None:
-        """Return agent ID to preload, or None if confidence is too low."""
-        agent_id, confidence = self.predict_next(current_agent)
-        return agent_id if agent_id else None
+    def should_preload(
+        self, current_agent: str, history: Sequence[str] = ()
+    ) -> tuple[str | None, float]:
+        """Decide whether pre-loading the predicted next agent is worth the cost.
+
+        The pair's pre-load success rate is sampled from
+        ``Beta(hits + 1, misses + 1)``, and the pre-load fires when the sample
+        times the prediction confidence reaches
+        ``preload_expected_value_threshold``. Untried pairs get a uniform prior,
+        so they are explored; pairs with a track record converge on their rate.
+
+        Returns:
+            (agent_id_to_preload, confidence), with None as the agent when the
+            pre-load should be skipped.
+        """
+        agent_id, confidence = self._best_next(current_agent, history)
+        if agent_id is None:
+            return None, 0.0
+        with self._lock:
+            hits, misses = self._preload_outcomes.get((current_agent, agent_id), (0, 0))
+            p = self._rng.betavariate(hits + 1, misses + 1)
+        if p * confidence >= self.config.preload_expected_value_threshold:
+            return agent_id, confidence
+        logger.debug(
+            "Skipping pre-load %s -> %s (sampled %.2f x confidence %.2f)",
+            current_agent,
+            agent_id,
+            p,
+            confidence,
+        )
+        return None, confidence
+
+    def record_preload(
+        self, hit: bool, from_agent: str | None = None, to_agent: str | None = None
+    ):
+        """Record whether a pre-load was used by the chain or thrown away.
+
+        When the pair that triggered the pre-load is given, the outcome also
+        feeds that pair's success rate used by ``should_preload``.
+        """
+        with self._lock:
+            if hit:
+                self._preload_hits += 1
+            else:
+                self._preload_wasted += 1
+            if from_agent is not None and to_agent is not None:
+                outcome = self._preload_outcomes.setdefault((from_agent, to_agent), [0, 0])
+                outcome[0 if hit else 1] += 1
 
     def stats(self) -> dict:
-        return {
-            "total_traces": self._total_traces,
-            "known_agents": list(self._transitions.keys()),
-            "transition_pairs": sum(
-                len(v) for v in self._transitions.values()
-            ),
-        }
+        with self._lock:
+            # Read contexts via _row_ctx; reading _ctx_row would refresh their LRU age
+            bigrams = [
+                (context[0], row) for row, context in enumerate(self._row_ctx)
+                if context is not None and len(context) == 1 and self._row_sum[row]
+            ]
+            return {
+                "total_traces": self._total_traces,
+                "known_agents": [self._id_to_agent[agent] for agent, _ in bigrams],
+                "transition_pairs": sum(
+                    int(np.count_nonzero(self._mat[row])) for _, row in bigrams
+                ),
+                "contexts": len(self._ctx_row),
+                "preload_hit": self._preload_hits,
+                "preload_wasted": self._preload_wasted,
+            }
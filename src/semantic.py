@@ -0,0 +1,152 @@
+"""Embedding index for serving near-duplicate requests from the cache."""
+
+import logging
+import re
+import threading
+from collections.abc import Callable
+
+import numpy as np
+from cachetools import LRUCache
+
+from .config import OptimizerConfig
+
+logger = logging.getLogger(__name__)
+
+_TOKEN_RE = re.compile(r"\w+")
+# Recently embedded texts; a chain embeds its input once per step otherwise
+_EMBEDDING_MEMO_SIZE = 1024
+
+
+def _tokens(text: str) -> frozenset[str]:
+    return frozenset(_TOKEN_RE.findall(text.lower()))
+
+
+class _Bucket:
+    """Unit-norm embeddings and cache keys for one lookup scope.
+
+    Rows are allocated geometrically up to the entry cap, after which the
+    bucket acts as a ring buffer and new entries overwrite the oldest.
+    """
+
+    def __init__(self, dim: int):
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.keys: list[str] = []
+        self.tokens: list[frozenset[str]] = []
+        self.known: set[str] = set()
+        self.next_slot = 0
+
+
+class SemanticIndex:
+    """Maps request inputs to cache keys of semantically similar past inputs.
+
+    Inputs are embedded with a sentence-transformers model and compared by
+    cosine similarity (inner product of unit vectors, the same search as a
+    flat inner-product index). Entries are partitioned by scope so a match
+    can only come from the same agent and request shape. Because embeddings
+    alone happily equate "topic 5" with "topic 6", every candidate must also
+    pass a lexical check: the same numbers, and enough shared words.
+    """
+
+    def __init__(
+        self,
+        config: OptimizerConfig,
+        encoder: Callable[[list[str]], np.ndarray] | None = None,
+    ):
+        self.config = config
+        if encoder is None:
+            try:
+                from sentence_transformers import SentenceTransformer
+            except ImportError as e:
+                raise ImportError(
+                    "semantic_cache requires sentence-transformers "
+                    "(pip install sentence-transformers)"
+                ) from e
+            model = SentenceTransformer(config.semantic_model)
+            encoder = lambda texts: model.encode(texts, normalize_embeddings=True)
+        self._encode = encoder
+        self._buckets: dict[str, _Bucket] = {}
+        self._embeddings = LRUCache(maxsize=_EMBEDDING_MEMO_SIZE)
+        self._lock = threading.Lock()
+
+    def _embed(self, texts: list[str]) -> list[np.ndarray]:
+        """Embed ``texts`` with at most one encoder call for the new ones."""
+        with self._lock:
+            vectors = {t: self._embeddings[t] for t in texts if t in self._embeddings}
+        pending = list(dict.fromkeys(t for t in texts if t not in vectors))
+        if pending:
+            encoded = np.asarray(self._encode(pending), dtype=np.float32)
+            with self._lock:
+                for text, vector in zip(pending, encoded):
+                    vectors[text] = self._embeddings[text] = vector
+        return [vectors[t] for t in texts]
+
+    def _validate(self, query: frozenset[str], candidate: frozenset[str]) -> bool:
+        numbers = lambda tokens: {t for t in tokens if any(c.isdigit() for c in t)}
+        if numbers(query) != numbers(candidate):
+            return False
+        union = query | candidate
+        overlap = len(query & candidate) / len(union) if union else 1.0
+        return overlap >= self.config.semantic_min_overlap
+
+    def add(self, scope: str, text: str, key: str):
+        """Index ``text`` so similar inputs in ``scope`` resolve to ``key``."""
+        with self._lock:
+            bucket = self._buckets.get(scope)
+            if bucket is not None and key in bucket.known:
+                return
+        vector = self._embed([text])[0]
+        with self._lock:
+            bucket = self._buckets.get(scope)
+            if bucket is None:
+                bucket = self._buckets[scope] = _Bucket(vector.shape[0])
+            if key in bucket.known:
+                return
+            bucket.known.add(key)
+            size, cap = len(bucket.keys), self.config.semantic_max_entries
+            if size < cap:
+                if size == bucket.vectors.shape[0]:
+                    grow = min(cap, max(16, size * 2)) - size
+                    bucket.vectors = np.pad(bucket.vectors, ((0, grow), (0, 0)))
+                bucket.vectors[size] = vector
+                bucket.keys.append(key)
+                bucket.tokens.append(_tokens(text))
+                return
+            slot = bucket.next_slot
+            bucket.known.discard(bucket.keys[slot])
+            bucket.vectors[slot] = vector
+            bucket.keys[slot] = key
+            bucket.tokens[slot] = _tokens(text)
+            bucket.next_slot = (slot + 1) % cap
+
+    def lookup(self, scope: str, text: str) -> str | None:
+        """Return the cache key of the closest valid match in ``scope``, if any."""
+        return self.lookup_many([(scope, text)])[0]
+
+    def lookup_many(self, queries: list[tuple[str, str]]) -> list[str | None]:
+        """``lookup`` for several ``(scope, text)`` queries, embedded in one batch."""
+        with self._lock:
+            searchable = [
+                i for i, (scope, _) in enumerate(queries)
+                if scope in self._buckets and self._buckets[scope].keys
+            ]
+        matches: list[str | None] = [None] * len(queries)
+        if not searchable:
+            return matches
+        vectors = self._embed([queries[i][1] for i in searchable])
+        with self._lock:
+            for i, vector in zip(searchable, vectors):
+                scope, text = queries[i]
+                matches[i] = self._search(self._buckets[scope], text, vector)
+        return matches
+
+    def _search(self, bucket: _Bucket, text: str, vector: np.ndarray) -> str | None:
+        query = _tokens(text)
+        scores = bucket.vectors[:len(bucket.keys)] @ vector
+        # Best-scoring candidates first; stop at the first one that validates
+        for i in np.argsort(scores)[::-1]:
+            if scores[i] < self.config.semantic_threshold:
+                break
+            if self._validate(query, bucket.tokens[i]):
+                logger.debug("Semantic match (score=%.3f) for %r", scores[i], text)
+                return bucket.keys[i]
+        return None
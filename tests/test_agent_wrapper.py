@@ -0,0 +1,206 @@
+"""Unit tests for the Bedrock agent wrapper."""
+
+import unittest
+from dataclasses import replace
+from unittest.mock import MagicMock, patch
+
+from src.agent_wrapper import BedrockAgentOptimizer
+from src.config import OptimizerConfig
+
+
+def predicts(source: str, target: str):
+    """should_preload stand-in that pre-loads ``target`` after ``source`` only."""
+    return lambda agent, history: (target, 0.8) if agent == source else (None, 0.0)
+
+
+class TestBedrockAgentOptimizer(unittest.TestCase):
+    def setUp(self):
+        self.config = OptimizerConfig(aws_region="us-east-1")
+        with patch("src.cache.redis.Redis"):
+            self.optimizer = BedrockAgentOptimizer(self.config)
+        self.optimizer.cache = MagicMock()
+        self.optimizer.cache.get.return_value = None
+        self.bedrock = MagicMock()
+        self.bedrock.invoke_agent.side_effect = lambda **kw: {
+            "completion": [{"chunk": {"bytes": f"{kw['agentId']} out".encode()}}]
+        }
+        self.optimizer._bedrock = self.bedrock
+        self.optimizer.router.should_preload = MagicMock(return_value=(None, 0.0))
+
+    def test_client_and_executor_are_shared(self):
+        with patch("src.cache.redis.Redis"):
+            first = BedrockAgentOptimizer(self.config)
+            other = BedrockAgentOptimizer(self.config)
+        self.assertIs(other._bedrock, first._bedrock)
+        self.assertIs(other._executor, self.optimizer._executor)
+
+    def test_executor_uses_configured_width(self):
+        self.assertEqual(
+            self.optimizer._executor._max_workers, self.config.max_parallel_requests
+        )
+
+    def test_client_pool_covers_executor(self):
+        with patch("src.cache.redis.Redis"):
+            optimizer = BedrockAgentOptimizer(self.config)
+        pool_size = optimizer._bedrock.meta.config.max_pool_connections
+        self.assertGreaterEqual(pool_size, self.config.max_parallel_requests)
+        self.assertGreaterEqual(pool_size, self.config.bedrock_pool_size)
+
+    def test_fully_cached_chain_skips_bedrock(self):
+        self.optimizer.cache.mget.return_value = [
+            {"agent_id": "A", "output": "a"},
+            {"agent_id": "B", "output": "b"},
+        ]
+        results = self.optimizer.run_chain(["A", "B"], "hello")
+        self.assertEqual([r["output"] for r in results], ["a", "b"])
+        self.optimizer.cache.mget.assert_called_once()
+        self.optimizer.cache.get.assert_not_called()
+        self.bedrock.invoke_agent.assert_not_called()
+        self.optimizer.router.should_preload.assert_not_called()
+
+    def test_chain_resumes_from_first_miss(self):
+        self.optimizer.cache.mget.return_value = [
+            {"agent_id": "A", "output": "a"}, None, None
+        ]
+        results = self.optimizer.run_chain(["A", "B", "C"], "hello")
+        self.assertEqual([r["output"] for r in results], ["a", "B out", "C out"])
+        calls = self.bedrock.invoke_agent.call_args_list
+        self.assertEqual([c.kwargs["agentId"] for c in calls], ["B", "C"])
+        self.assertEqual(calls[0].kwargs["inputText"], "a")
+        # Tail steps are looked up and stored only under their projected keys
+        self.optimizer.cache.get.assert_not_called()
+        stored = [c.args[1:] for c in self.optimizer.cache.put.call_args_list]
+        self.assertEqual(
+            [(payload, context) for payload, _, context in stored],
+            [
+                ({"input_text": "hello", "upstream": ["A"]}, None),
+                ({"input_text": "hello", "upstream": ["A", "B"]}, None),
+            ],
+        )
+
+    def test_repeated_query_is_served_from_cache_later(self):
+        store = {}
+        client = MagicMock()
+        client.get.side_effect = store.get
+        client.mget.side_effect = lambda keys: [store.get(k) for k in keys]
+        client.pipeline.return_value.setex.side_effect = (
+            lambda key, ttl, value: store.__setitem__(key, value)
+        )
+        with patch("src.cache.redis.Redis"):
+            optimizer = BedrockAgentOptimizer(self.config)
+        optimizer.cache.client = client
+        optimizer._bedrock = self.bedrock
+        optimizer.router.should_preload = MagicMock(return_value=(None, 0.0))
+
+        with patch("src.agent_wrapper.time.time", return_value=1000.0):
+            first = optimizer.run_chain(["A", "B"], "hello")
+        # A cold chain costs one MGET and one write per step, nothing more
+        client.get.assert_not_called()
+        self.assertEqual(client.pipeline.return_value.setex.call_count, 2)
+        optimizer.cache._l1.clear()
+        with patch("src.agent_wrapper.time.time", return_value=2000.0):
+            second = optimizer.run_chain(["A", "B"], "hello")
+
+        self.assertEqual(self.bedrock.invoke_agent.call_count, 2)
+        self.assertEqual(
+            [r["output"] for r in second], [r["output"] for r in first]
+        )
+        # One outcome per step: two misses on the first run, two hits on the second
+        stats = optimizer.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 2))
+
+    def test_preload_is_submitted_before_current_agent_runs(self):
+        events = []
+        self.optimizer.cache.mget.return_value = [None, None]
+        self.bedrock.invoke_agent.side_effect = lambda **kw: (
+            events.append(f"invoke:{kw['agentId']}") or {"completion": []}
+        )
+        self.optimizer.router.should_preload.side_effect = predicts("A", "B")
+        self.optimizer._executor = MagicMock()
+        self.optimizer._executor.submit.side_effect = lambda fn, agent, ctx, conf: (
+            events.append(f"preload:{agent}") or MagicMock()
+        )
+        self.optimizer.run_chain(["A", "B"], "hello")
+        self.assertEqual(events, ["preload:B", "invoke:A", "invoke:B"])
+        self.assertNotIn("B", self.optimizer._preloaded)
+
+    def test_completion_decodes_characters_split_across_chunks(self):
+        encoded = "café ☕".encode()
+        chunks = [encoded[i:i + 1] for i in range(len(encoded))]
+        self.bedrock.invoke_agent.side_effect = lambda **kw: {
+            "completion": [{"chunk": {"bytes": b}} for b in chunks]
+        }
+        result = self.optimizer._invoke_agent("A", {"input_text": "hi"})
+        self.assertEqual(result["output"], "café ☕")
+
+    def test_preload_warms_connection_without_invoking(self):
+        # Probes are opt-in, so even a certain prediction sends no invocation
+        self.optimizer._preload_context("B", {"session_id": "s"}, confidence=1.0)
+        self.bedrock._endpoint.http_session.send.assert_called_once()
+        self.bedrock.invoke_agent.assert_not_called()
+
+    def test_preload_probes_session_when_enabled(self):
+        self.optimizer.config = replace(self.config, preload_probe_threshold=0.9)
+        self.optimizer._preload_context("B", {"session_id": "s"}, confidence=0.95)
+        self.bedrock.invoke_agent.assert_called_once()
+        self.assertEqual(self.bedrock.invoke_agent.call_args.kwargs["agentId"], "B")
+
+    def test_pending_preloads_are_bounded(self):
+        config = OptimizerConfig(preload_max_pending=2)
+        with patch("src.cache.redis.Redis"):
+            optimizer = BedrockAgentOptimizer(config)
+        optimizer._executor = MagicMock()
+        futures = [MagicMock() for _ in range(3)]
+        optimizer._executor.submit.side_effect = futures
+        for agent in ("X", "Y", "Z"):
+            optimizer.router.should_preload = MagicMock(return_value=(agent, 0.8))
+            optimizer._preload_next("A", {"session_id": "s"}, [])
+        self.assertEqual(list(optimizer._preloaded), ["Y", "Z"])
+        futures[0].cancel.assert_called_once()
+        self.assertEqual(optimizer.router.stats()["preload_wasted"], 1)
+
+    def test_stale_preloads_expire(self):
+        config = OptimizerConfig(preload_ttl_ms=0)
+        with patch("src.cache.redis.Redis"):
+            optimizer = BedrockAgentOptimizer(config)
+        optimizer._executor = MagicMock()
+        optimizer.router.should_preload = MagicMock(return_value=("B", 0.8))
+        optimizer._preload_next("A", {"session_id": "s"}, [])
+        optimizer._expire_preloads()
+        self.assertEqual(len(optimizer._preloaded), 0)
+        optimizer._executor.submit.return_value.cancel.assert_called_once()
+
+    def test_consumed_preload_counts_as_hit(self):
+        self.optimizer.cache.mget.return_value = [None, None]
+        self.optimizer.router.should_preload.side_effect = predicts("A", "B")
+        self.optimizer._executor = MagicMock()
+        results = self.optimizer.run_chain(["A", "B"], "hello")
+        stats = self.optimizer.router.stats()
+        self.assertEqual((stats["preload_hit"], stats["preload_wasted"]), (1, 0))
+        self.assertEqual([r["warm"] for r in results], [False, True])
+        self.assertEqual(self.optimizer.router._preload_outcomes[("A", "B")], [1, 0])
+
+    def test_failed_preload_counts_as_miss(self):
+        self.optimizer.cache.mget.return_value = [None, None]
+        self.optimizer.router.should_preload.side_effect = predicts("A", "B")
+        self.optimizer._executor = MagicMock()
+        self.optimizer._executor.submit.return_value.result.return_value = False
+        results = self.optimizer.run_chain(["A", "B"], "hello")
+        self.assertEqual([r["warm"] for r in results], [False, False])
+        self.assertEqual(self.optimizer.router._preload_outcomes[("A", "B")], [0, 1])
+        # The confidence passed on is the one should_preload returned
+        _, _, _, confidence = self.optimizer._executor.submit.call_args.args
+        self.assertEqual(confidence, 0.8)
+
+    def test_mispredicted_preload_counts_as_miss(self):
+        self.optimizer.cache.mget.return_value = [None, None]
+        self.optimizer.router.should_preload.side_effect = predicts("A", "C")
+        self.optimizer._executor = MagicMock()
+        self.optimizer.run_chain(["A", "B"], "hello")
+        self.assertNotIn("C", self.optimizer._preloaded)
+        self.optimizer._executor.submit.return_value.cancel.assert_called_once()
+        self.assertEqual(self.optimizer.router._preload_outcomes[("A", "C")], [0, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
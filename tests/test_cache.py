@@ -1,11 +1,36 @@
 """Unit tests for the caching layer and predictive router."""
 
+import time
 import unittest
 from unittest.mock import MagicMock, patch
 
+import numpy as np
+
 from src.cache import AgentResponseCache
-from src.config import OptimizerConfig
+from src.config import OptimizerConfig, get_config
 from src.router import PredictiveRouter
+from src.semantic import SemanticIndex
+
+
+def bag_of_words(texts: list[str]) -> np.ndarray:
+    """Deterministic stand-in for a sentence embedding model."""
+    vectors = np.zeros((len(texts), 64), dtype=np.float32)
+    for row, text in zip(vectors, texts):
+        for token in text.lower().split():
+            row[sum(map(ord, token)) % 64] += 1
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+class TestOptimizerConfig(unittest.TestCase):
+    def test_config_is_immutable(self):
+        config = OptimizerConfig()
+        with self.assertRaises(AttributeError):
+            config.cache_ttl = 1
+        self.assertIsInstance(config.agent_ids, tuple)
+        self.assertEqual(hash(config), hash(OptimizerConfig()))
+
+    def test_get_config_is_cached(self):
+        self.assertIs(get_config(), get_config())
 
 
 class TestAgentResponseCache(unittest.TestCase):
@@ -15,6 +40,19 @@ class TestAgentResponseCache(unittest.TestCase):
             self.cache = AgentResponseCache(self.config)
             self.cache.client = MagicMock()
 
+    def test_client_is_created_lazily_with_sized_pool(self):
+        config = OptimizerConfig(redis_pool_size=64, max_parallel_requests=40)
+        with patch("src.cache.redis.Redis") as redis_cls, patch(
+            "src.cache.redis.BlockingConnectionPool"
+        ) as pool_cls:
+            cache = AgentResponseCache(config)
+            redis_cls.assert_not_called()
+            self.assertIs(cache.client, cache.client)
+        redis_cls.assert_called_once_with(connection_pool=pool_cls.return_value)
+        _, kwargs = pool_cls.call_args
+        self.assertEqual(kwargs["max_connections"], 80)
+        self.assertFalse(kwargs["decode_responses"])
+
     def test_cache_miss_returns_none(self):
         self.cache.client.get.return_value = None
         result = self.cache.get("agent-1", {"input_text": "hello"})
@@ -22,16 +60,153 @@ class TestAgentResponseCache(unittest.TestCase):
         self.assertEqual(self.cache._misses, 1)
 
     def test_cache_hit_returns_data(self):
-        self.cache.client.get.return_value = '{"output": "cached"}'
+        self.cache.client.get.return_value = self.cache._encode({"output": "cached"})
         result = self.cache.get("agent-1", {"input_text": "hello"})
         self.assertEqual(result, {"output": "cached"})
         self.assertEqual(self.cache._hits, 1)
 
+    def test_mget_single_round_trip(self):
+        self.cache.client.mget.return_value = [self.cache._encode({"output": "a"}), None]
+        results = self.cache.mget([
+            ("agent-1", {"input_text": "hello"}, None),
+            ("agent-2", {"input_text": "hello"}, None),
+        ])
+        self.assertEqual(results, [{"output": "a"}, None])
+        self.cache.client.mget.assert_called_once()
+        self.cache.client.get.assert_not_called()
+        self.assertEqual((self.cache._hits, self.cache._misses), (1, 1))
+
+    def test_repeat_miss_skips_redis(self):
+        self.cache.client.get.return_value = None
+        self.cache.get("agent-1", {"input_text": "hello"})
+        self.cache.get("agent-1", {"input_text": "hello"})
+        self.cache.client.get.assert_called_once()
+        self.assertEqual(self.cache._misses, 2)
+
+    def test_put_clears_negative_entry(self):
+        self.cache.client.get.return_value = None
+        self.cache.get("agent-1", {"input_text": "hello"})
+        self.cache.put("agent-1", {"input_text": "hello"}, {"output": "world"})
+        key = AgentResponseCache._build_key("agent-1", {"input_text": "hello"})
+        self.assertNotIn(key, self.cache._negative)
+
+    def test_mget_skips_known_misses(self):
+        self.cache.client.get.return_value = None
+        self.cache.get("agent-1", {"input_text": "hello"})
+        self.cache.client.mget.return_value = [None]
+        self.cache.mget([
+            ("agent-1", {"input_text": "hello"}, None),
+            ("agent-2", {"input_text": "hello"}, None),
+        ])
+        (keys,), _ = self.cache.client.mget.call_args
+        expected = AgentResponseCache._build_key("agent-2", {"input_text": "hello"})
+        self.assertEqual(keys, [expected])
+
+    def test_put_populates_l1(self):
+        self.cache.put("agent-1", {"input_text": "hello"}, {"output": "world"})
+        result = self.cache.get("agent-1", {"input_text": "hello"})
+        self.assertEqual(result, {"output": "world"})
+        self.cache.client.get.assert_not_called()
+
+    def test_l1_entries_expire_with_cache_ttl(self):
+        self.cache.put("agent-1", {"input_text": "hello"}, {"output": "old"})
+        self.cache._l1.expire(time.monotonic() + self.config.cache_ttl + 1)
+        self.cache.client.get.return_value = None
+        self.assertIsNone(self.cache.get("agent-1", {"input_text": "hello"}))
+        self.cache.client.get.assert_called_once()
+
+    def test_redis_hit_populates_l1(self):
+        self.cache.client.get.return_value = self.cache._encode({"output": "cached"})
+        first = self.cache.get("agent-1", {"input_text": "hello"})
+        first["latency_ms"] = 1.0  # callers annotate results; L1 must not see it
+        second = self.cache.get("agent-1", {"input_text": "hello"})
+        self.assertEqual(second, {"output": "cached"})
+        self.cache.client.get.assert_called_once()
+        self.assertEqual(self.cache._hits, 2)
+
     def test_put_stores_with_ttl(self):
         self.cache.put("agent-1", {"input_text": "hello"}, {"output": "world"})
-        self.cache.client.setex.assert_called_once()
-        args = self.cache.client.setex.call_args
+        pipe = self.cache.client.pipeline.return_value
+        pipe.setex.assert_called_once()
+        args = pipe.setex.call_args
         self.assertEqual(args[0][1], self.config.cache_ttl)
+        pipe.execute.assert_called_once()
+
+    def test_put_many_uses_one_pipeline(self):
+        self.cache.put_many([
+            ("agent-1", {"input_text": "a"}, {"output": "x"}, None),
+            ("agent-1", {"input_text": "b"}, {"output": "y"}, None),
+        ])
+        self.cache.client.pipeline.assert_called_once_with(transaction=False)
+        pipe = self.cache.client.pipeline.return_value
+        self.assertEqual(pipe.setex.call_count, 2)
+        pipe.execute.assert_called_once()
+
+    def test_chain_shaped_key_takes_fast_path(self):
+        payload = {"input_text": "hi", "session_id": "s"}
+        with patch("src.cache.msgpack.packb") as packb:
+            key = AgentResponseCache._build_key("agent-1", payload, {"session_id": "s"})
+        packb.assert_not_called()
+        self.assertTrue(key.startswith("bedrock_cache:{agent-1}:"))
+        self.assertNotEqual(
+            key, AgentResponseCache._build_key("agent-1", payload, {"session_id": "other"})
+        )
+
+    def test_chain_shaped_keys_do_not_collide(self):
+        build = AgentResponseCache._build_key
+        a = build("agent-1", {"input_text": "x\0y", "session_id": "s"}, {"session_id": "s"})
+        b = build("agent-1", {"input_text": "x", "session_id": "y\0s"}, {"session_id": "y\0s"})
+        c = build("agent-1", {"input_text": "x", "session_id": "ys"}, {"session_id": "ys"})
+        self.assertEqual(len({a, b, c}), 3)
+
+    def test_keys_are_hash_tagged_by_agent(self):
+        key = AgentResponseCache._build_key("agent-1", {"input_text": "hello"})
+        self.assertTrue(key.startswith("bedrock_cache:{agent-1}:"))
+
+    def test_small_values_are_not_compressed(self):
+        raw = self.cache._encode({"output": "short"})
+        self.assertEqual(raw[:1], b"m")
+        self.assertEqual(self.cache._decode(raw), {"output": "short"})
+
+    def test_large_values_are_compressed(self):
+        response = {"output": "x" * (self.config.compression_threshold * 2)}
+        raw = self.cache._encode(response)
+        self.assertEqual(raw[:1], b"z")
+        self.assertLess(len(raw), self.config.compression_threshold)
+        self.assertEqual(self.cache._decode(raw), response)
+
+    def test_legacy_json_value_is_a_miss(self):
+        self.cache.client.get.return_value = b'{"output": "cached"}'
+        self.assertIsNone(self.cache.get("agent-1", {"input_text": "hello"}))
+        self.assertEqual(self.cache._misses, 1)
+
+    def test_key_ignores_dict_order(self):
+        a = AgentResponseCache._build_key(
+            "agent-1",
+            {"input_text": "hi", "session_id": "s", "meta": {"x": 1, "y": [{"b": 2, "a": 1}]}},
+            {"b": 2, "a": 1},
+        )
+        b = AgentResponseCache._build_key(
+            "agent-1",
+            {"meta": {"y": [{"a": 1, "b": 2}], "x": 1}, "session_id": "s", "input_text": "hi"},
+            {"a": 1, "b": 2},
+        )
+        self.assertEqual(a, b)
+        self.assertTrue(a.startswith("bedrock_cache:"))
+
+    def test_key_distinguishes_inputs(self):
+        build = AgentResponseCache._build_key
+        base = build("agent-1", {"input_text": "hi"})
+        self.assertNotEqual(base, build("agent-2", {"input_text": "hi"}))
+        self.assertNotEqual(base, build("agent-1", {"input_text": "Hi"}))
+        self.assertNotEqual(base, build("agent-1", {"input_text": "hi"}, {"session_id": "s"}))
+        self.assertNotEqual(build("a", {"input_text": None}), build("a", {"input_text": "None"}))
+        self.assertNotEqual(build("a", {}), build("a", {"input_text": ""}))
+        self.assertNotEqual(
+            build("a", {"input_text": "x\0y", "lang": "en"}),
+            build("a", {"input_text": "x", "lang": "y\0en"}),
+        )
+        self.assertNotEqual(build("a", {"m": {"k": 1}}), build("a", {"m": [["k", 1]]}))
 
     def test_hit_rate_calculation(self):
         self.cache._hits = 3
@@ -39,6 +214,78 @@ class TestAgentResponseCache(unittest.TestCase):
         self.assertAlmostEqual(self.cache.hit_rate, 0.3)
 
 
+class TestSemanticCache(unittest.TestCase):
+    def setUp(self):
+        self.config = OptimizerConfig(semantic_threshold=0.5)
+        with patch("src.cache.redis.Redis"):
+            self.cache = AgentResponseCache(self.config)
+            self.cache.client = MagicMock()
+        self.cache.client.get.return_value = None
+        self.cache.semantic = SemanticIndex(self.config, encoder=bag_of_words)
+        self.cache.put("agent-1", {"input_text": "Query about topic 5"}, {"output": "five"})
+        self.cache._l1.clear()
+
+    def _serve_stored(self):
+        key, _, stored = self.cache.client.pipeline.return_value.setex.call_args[0]
+        self.cache.client.mget.side_effect = lambda keys: [
+            stored if k == key else None for k in keys
+        ]
+
+    def test_near_duplicate_is_served(self):
+        self._serve_stored()
+        result = self.cache.get("agent-1", {"input_text": "query about topic 5"})
+        self.assertEqual(result, {"output": "five"})
+        self.assertEqual(self.cache.stats()["semantic_hits"], 1)
+
+    def test_uncounted_mget_still_counts_semantic_hits(self):
+        self._serve_stored()
+        self.cache.mget([("agent-1", {"input_text": "query about topic 5"}, None)], count=False)
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["semantic_hits"]), (0, 1))
+
+    def test_mget_fetches_semantic_matches_in_one_round_trip(self):
+        self._serve_stored()
+        results = self.cache.mget([
+            ("agent-1", {"input_text": "query about topic 5"}, None),
+            ("agent-1", {"input_text": "QUERY about topic 5"}, None),
+            ("agent-2", {"input_text": "query about topic 5"}, None),
+        ])
+        self.assertEqual(results, [{"output": "five"}, {"output": "five"}, None])
+        # One read for the keys themselves, one for both semantic matches
+        self.assertEqual(self.cache.client.mget.call_count, 2)
+        self.cache.client.get.assert_not_called()
+
+    def test_different_number_is_rejected(self):
+        self.assertIsNone(self.cache.get("agent-1", {"input_text": "Query about topic 6"}))
+
+    def test_other_agent_is_not_matched(self):
+        self.assertIsNone(self.cache.get("agent-2", {"input_text": "Query about topic 5"}))
+
+    def test_embeddings_are_batched_and_reused(self):
+        calls = []
+        encoder = lambda texts: calls.append(list(texts)) or bag_of_words(texts)
+        self.cache.semantic = SemanticIndex(self.config, encoder=encoder)
+        self.cache.put("agent-1", {"input_text": "Query about topic 5"}, {"output": "five"})
+        self.cache.put("agent-1", {"input_text": "Query about topic 5"}, {"output": "five"})
+        self.cache.put("agent-1", {"input_text": "Query about topic 5", "k": 1}, {"output": "5"})
+        self.assertEqual(calls, [["Query about topic 5"]])
+        self.cache.client.mget.return_value = [None] * 3
+        self.cache.mget([
+            ("agent-1", {"input_text": "topic 5 query"}, None),
+            ("agent-1", {"input_text": "topic 5 query", "k": 1}, None),
+            ("agent-2", {"input_text": "topic 5 query"}, None),
+        ])
+        # Only scopes with entries are searched, and each text is embedded once
+        self.assertEqual(calls[1:], [["topic 5 query"]])
+
+    def test_index_evicts_oldest_when_full(self):
+        index = SemanticIndex(OptimizerConfig(semantic_max_entries=2), encoder=bag_of_words)
+        for i, text in enumerate(["alpha one", "beta two", "gamma three"]):
+            index.add("scope", text, f"key-{i}")
+        self.assertIsNone(index.lookup("scope", "alpha one"))
+        self.assertEqual(index.lookup("scope", "gamma three"), "key-2")
+
+
 class TestPredictiveRouter(unittest.TestCase):
     def setUp(self):
         self.config = OptimizerConfig(prediction_threshold=0.7)
@@ -70,6 +317,94 @@ class TestPredictiveRouter(unittest.TestCase):
         agent, _ = self.router.predict_next("Y")
         self.assertEqual(agent, "Z")
 
+    def test_ingest_trace_matches_record_transition(self):
+        for trace in ([f"agent-{i % 11}" for i in range(40)], ["B", "A", "C", "A", "B"]):
+            batch, single = PredictiveRouter(self.config), PredictiveRouter(self.config)
+            batch.ingest_trace(trace)
+            for i in range(1, len(trace)):
+                single.record_transition(trace[i - 1], trace[i], trace[:i - 1])
+            self.assertEqual(batch.stats(), single.stats())
+            for agent in set(trace):
+                self.assertEqual(batch.predict_next(agent), single.predict_next(agent))
+                # Unthresholded, so ties (A -> B or C) are compared too
+                self.assertEqual(batch._best_next(agent, ()), single._best_next(agent, ()))
+        self.assertEqual(batch._best_next("A", ()), ("B", 0.5))
+
+    def test_best_successor_tracks_shifting_counts(self):
+        self.router.record_transition("A", "B")
+        for _ in range(3):
+            self.router.record_transition("A", "C")
+        agent, conf = self.router.predict_next("A")
+        self.assertEqual(agent, "C")
+        self.assertAlmostEqual(conf, 0.75)
+        for _ in range(7):
+            self.router.record_transition("A", "B")
+        agent, conf = self.router.predict_next("A")
+        self.assertEqual(agent, "B")
+        self.assertAlmostEqual(conf, 8 / 11)
+
+    def test_history_disambiguates_shared_agent(self):
+        for _ in range(5):
+            self.router.ingest_trace(["A", "B", "C"])
+            self.router.ingest_trace(["D", "B", "E"])
+        self.assertEqual(self.router.predict_next("B", ["A"])[0], "C")
+        self.assertEqual(self.router.predict_next("B", ["D"])[0], "E")
+        # Without history the bigram context is a coin flip
+        self.assertEqual(self.router.predict_next("B"), (None, 0.5))
+
+    def test_unseen_history_backs_off_to_shorter_context(self):
+        for _ in range(5):
+            self.router.record_transition("B", "C", ["A"])
+        self.assertEqual(self.router.predict_next("B", ["X", "Y"]), ("C", 1.0))
+
+    def test_context_cap_evicts_least_recently_used(self):
+        router = PredictiveRouter(OptimizerConfig(router_max_order=1, router_ngram_cap=2))
+        router.record_transition("A", "B")
+        router.record_transition("C", "D")
+        router.predict_next("A")  # refresh A so C is the oldest
+        router.record_transition("E", "F")
+        self.assertEqual(router.predict_next("A")[0], "B")
+        self.assertEqual(router.predict_next("C"), (None, 0.0))
+        self.assertEqual(router.predict_next("E")[0], "F")
+        self.assertEqual(router.stats()["contexts"], 2)
+
+    def test_repeated_agents_in_trace_are_all_counted(self):
+        self.router.ingest_trace(["A", "B", "A", "B", "A", "C"])
+        agent, conf = self.router.predict_next("A")
+        self.assertIsNone(agent)
+        self.assertAlmostEqual(conf, 2 / 3)
+        self.assertEqual(self.router.stats()["total_traces"], 5)
+
+    def test_higher_order_contexts_near_chain_start(self):
+        router = PredictiveRouter(OptimizerConfig(router_max_order=4))
+        router.ingest_trace(["X", "A", "B", "C"])
+        router.ingest_trace(["Y", "A", "B", "D"])
+        self.assertEqual(router.predict_next("B", ["X", "A"]), ("C", 1.0))
+        self.assertEqual(router.predict_next("B", ["Y", "A"]), ("D", 1.0))
+        router.record_transition("B", "E", ["Z", "A"])
+        self.assertEqual(router.predict_next("B", ["Z", "A"]), ("E", 1.0))
+
+    def test_lookups_do_not_intern_unknown_agents(self):
+        self.router.ingest_trace(["A", "B", "C"])
+        self.assertEqual(self.router.predict_next("B", ["unseen"])[0], "C")
+        self.assertEqual(self.router.predict_next("unseen"), (None, 0.0))
+        self.assertEqual(self.router._id_to_agent, ["A", "B", "C"])
+
+    def test_preload_decision_follows_measured_success(self):
+        self.router._rng.seed(0)
+        self.router.ingest_trace(["A", "B", "A", "C", "A", "B"])
+        self.assertIsNone(self.router.predict_next("A")[0])
+
+        for _ in range(50):
+            self.router.record_preload(True, "A", "B")
+        self.assertTrue(all(self.router.should_preload("A")[0] == "B" for _ in range(20)))
+
+        for _ in range(500):
+            self.router.record_preload(False, "A", "B")
+        self.assertTrue(all(self.router.should_preload("A")[0] is None for _ in range(20)))
+        stats = self.router.stats()
+        self.assertEqual((stats["preload_hit"], stats["preload_wasted"]), (50, 500))
+
 
 if __name__ == "__main__":
     unittest.main()